@@ -4,94 +4,337 @@
 
 # Micropython code for sensing when the washer/dryer is finished.
 
-import _thread
 import json
 import sys
-import time
 
+import micropython
 import uasyncio as asyncio
-from machine import SoftI2C, Pin
+from array import array
+from machine import I2C, Pin
+from micropython import const
 
-import mpu6050
 import mqtt_local
 from mqtt_as import MQTTClient
 
-# motion is indicated by the 3 accelerometer readings combined being greater than this threshold
-sensitivity = 110
+# defaults, each can be overridden by the config topic
+# motion is indicated by the magnitude of the change in the 3 gyro readings being greater than this threshold
+SENSITIVITY = const(110)
+# done means no motion within SAMPLE_SECS * MAX_IDLE_PERIODS seconds
+SAMPLE_SECS = const(10)
+MAX_IDLE_PERIODS = const(6)
+
+sensitivity = SENSITIVITY
+# compared against the squared magnitude so no square root is needed, keep in sync with sensitivity
+sens_sq = SENSITIVITY * SENSITIVITY
+sample_secs = SAMPLE_SECS
+max_idle_periods = MAX_IDLE_PERIODS
 idle_counter = 0
 
-# done means no motion within SAMPLE_SECS * MAX_IDLE_PERIODS seconds
-sample_secs = 10
-max_idle_periods = 6
+# debug prints are compiled out when this is 0
+DEBUG = const(0)
 
 client = None
-command = None
 
-BASE_TOPIC = 'esp32/washer'
-DEVICE_STATUS_TOPIC = f'{BASE_TOPIC}/status'
-CONFIG_TOPIC = f'{BASE_TOPIC}/config'
-ACTIVE_TOPIC = f'{BASE_TOPIC}/active/1'
-READINGS_TOPIC = f'{BASE_TOPIC}/readings/1'
-NOTIFY_TOPIC = f'{BASE_TOPIC}/notify'
-COMMAND_TOPIC = f'{ACTIVE_TOPIC}/set'
+# bytes so incoming topics, which mqtt_as delivers as bytes, can be compared without decoding
+# kept short since the topic is sent with every publish
+BASE_TOPIC = b'w'
+DEVICE_STATUS_TOPIC = BASE_TOPIC + b'/s'
+CONFIG_TOPIC = BASE_TOPIC + b'/c'
+ACTIVE_TOPIC = BASE_TOPIC + b'/a'
+READINGS_TOPIC = BASE_TOPIC + b'/r'
+NOTIFY_TOPIC = BASE_TOPIC + b'/n'
+COMMAND_TOPIC = ACTIVE_TOPIC + b'/set'
 
-config_done = False
+config_event = asyncio.Event()
+# uasyncio has no Queue; only the latest command matters so a single pending slot plus an Event is enough
+command = None
+command_event = asyncio.Event()
 is_active = False
-accelerometer_changes = None
-notification = None
 
-i2c = SoftI2C(scl=Pin(16), sda=Pin(17))
-accelerometer = mpu6050.accel(i2c)
+MPU_ADDR = const(0x68)
+SMPLRT_DIV = const(0x19)
+CONFIG = const(0x1A)
+ACCEL_CONFIG = const(0x1C)
+MOT_THR = const(0x1F)
+MOT_DUR = const(0x20)
+FIFO_EN = const(0x23)
+INT_PIN_CFG = const(0x37)
+INT_ENABLE = const(0x38)
+USER_CTRL = const(0x6A)
+PWR_MGMT_1 = const(0x6B)
+FIFO_COUNTH = const(0x72)
+FIFO_R_W = const(0x74)
+
+FIFO_SIZE = const(1024)
+# each FIFO sample is GyX, GyY, GyZ as big-endian signed 16 bit values
+SAMPLE_BYTES = const(6)
+# marks _last as empty, outside the 16 bit range of a real reading
+NO_READING = const(0x10000)
+# fixed 5Hz gyro sample rate (1kHz / (1 + 199)) so sensitivity means the same whatever sampleSecs is
+SAMPLE_RATE_DIV = const(199)
+SAMPLE_MS = const(200)
+# the FIFO holds 170 samples, ~34 secs at 5Hz, so drain it at least this often
+DRAIN_SECS = const(20)
+
+# GPIO the MPU6050 INT output is wired to
+INT_PIN = const(4)
+# motion interrupt fires when acceleration changes by more than motion_threshold * 2mg for MOTION_DURATION ms,
+# overridable by the config topic
+MOTION_THRESHOLD = const(20)
+MOTION_DURATION = const(1)
+motion_threshold = MOTION_THRESHOLD
+
+i2c = I2C(0, scl=Pin(16), sda=Pin(17), freq=400_000)
+# wake the MPU6050 up from sleep mode
+i2c.writeto_mem(MPU_ADDR, PWR_MGMT_1, b'\x00')
+# motion detection needs the accelerometer high pass filter (5Hz, keeping the +-2g range)
+i2c.writeto_mem(MPU_ADDR, ACCEL_CONFIG, b'\x01')
+
+
+def set_motion_threshold(value):
+    i2c.writeto_mem(MPU_ADDR, MOT_THR, bytes((value,)))
+
+
+set_motion_threshold(MOTION_THRESHOLD)
+i2c.writeto_mem(MPU_ADDR, MOT_DUR, bytes((MOTION_DURATION,)))
+# INT is active high, push-pull and pulses for 50us on each event
+i2c.writeto_mem(MPU_ADDR, INT_PIN_CFG, b'\x00')
+i2c.writeto_mem(MPU_ADDR, INT_ENABLE, b'\x40')
+# digital low pass filter on, which sets the gyro output rate to 1kHz
+i2c.writeto_mem(MPU_ADDR, CONFIG, b'\x01')
+i2c.writeto_mem(MPU_ADDR, SMPLRT_DIV, bytes((SAMPLE_RATE_DIV,)))
+# only the gyro goes into the FIFO
+i2c.writeto_mem(MPU_ADDR, FIFO_EN, b'\x70')
+
+
+def reset_fifo():
+    # FIFO_EN plus FIFO_RESET, which clears itself
+    i2c.writeto_mem(MPU_ADDR, USER_CTRL, b'\x44')
+    # the reading before the reset may be long gone, the next batch starts from its own first sample
+    _last[0] = NO_READING
+
+
+# set from the pin interrupt; without it the FIFO samples aren't worth reading
+motion_flag = asyncio.ThreadSafeFlag()
+motion_seen = False
+
+
+def _on_motion(pin):
+    motion_flag.set()
+
+
+Pin(INT_PIN, Pin.IN, Pin.PULL_UP).irq(trigger=Pin.IRQ_RISING, handler=_on_motion)
+
+# whole FIFO worth of samples, read in one burst per drain
+_fifo_buf = bytearray(FIFO_SIZE - FIFO_SIZE % SAMPLE_BYTES)
+_fifo_mv = memoryview(_fifo_buf)
+_count_buf = bytearray(2)
+
 
-last_readings = accelerometer.get_values()
+def read_fifo():
+    # reads the whole samples waiting in the FIFO into _fifo_buf and returns how many bytes that is
+    i2c.readfrom_mem_into(MPU_ADDR, FIFO_COUNTH, _count_buf)
+    n = _count_buf[0] << 8 | _count_buf[1]
+    if n >= FIFO_SIZE:
+        # only if the loop was held up, e.g. by a publish waiting out a broker outage; samples were dropped and
+        # the rest are no longer aligned so start over
+        reset_fifo()
+        return 0
+    n -= n % SAMPLE_BYTES
+    if n:
+        i2c.readfrom_mem_into(MPU_ADDR, FIFO_R_W, _fifo_mv[:n])
+    return n
 
 
-def update_readings_thread():
-    global accelerometer_changes, last_readings, idle_counter, command, notification
+# last gyro reading of the previous batch, NO_READING after the FIFO is reset
+_last = array('i', (0, 0, 0))
+# largest change between consecutive readings so far in the current sample period
+_change = array('i', (0, 0, 0))
+
+
+# native rather than viper: squared 16 bit differences overflow viper's machine sized ints
+@micropython.native
+def _max_change(buf, n, last, change):
+    # folds the readings in the first n bytes of buf into change and returns its squared magnitude,
+    # so a sample period can be drained in several reads
+    # readings are decoded in place rather than through struct.unpack so no tuple is allocated per sample
+    best = change[0] * change[0] + change[1] * change[1] + change[2] * change[2]
+    lx = last[0]
+    ly = last[1]
+    lz = last[2]
+    for i in range(0, n, SAMPLE_BYTES):
+        gx = buf[i] << 8 | buf[i + 1]
+        if gx & 0x8000:
+            gx -= 0x10000
+        gy = buf[i + 2] << 8 | buf[i + 3]
+        if gy & 0x8000:
+            gy -= 0x10000
+        gz = buf[i + 4] << 8 | buf[i + 5]
+        if gz & 0x8000:
+            gz -= 0x10000
+        if lx != NO_READING:
+            dx = lx - gx
+            dy = ly - gy
+            dz = lz - gz
+            d = dx * dx + dy * dy + dz * dz
+            if d > best:
+                best = d
+                change[0] = dx
+                change[1] = dy
+                change[2] = dz
+        lx = gx
+        ly = gy
+        lz = gz
+    last[0] = lx
+    last[1] = ly
+    last[2] = lz
+    return best
+
+
+reset_fifo()
+
+
+# readings are formatted in place so publishing doesn't allocate a new string every sample
+_pub_buf = bytearray(48)
+
+
+def _itoa(buf, pos, value):
+    # writes the decimal digits of abs(value) into buf at pos and returns the position after them
+    if value < 0:
+        value = -value
+    end = pos + 1
+    v = value
+    while v >= 10:
+        v //= 10
+        end += 1
+    i = end
+    while True:
+        i -= 1
+        buf[i] = 0x30 + value % 10
+        value //= 10
+        if not value:
+            return end
+
+
+async def motion_loop():
+    global motion_seen
+    while True:
+        await motion_flag.wait()
+        motion_seen = True
+
+
+async def sample_loop():
+    global idle_counter, motion_seen
+    # local aliases avoid a global/attribute lookup on every pass
+    read = read_fifo
+    max_change = _max_change
+    buf = _fifo_buf
+    last = _last
+    change = _change
+    itoa = _itoa
+    publish = client.publish
+    sleep = asyncio.sleep
+    mv = memoryview(_pub_buf)
     while True:
         if is_active:
-            accelerometer_values = accelerometer.get_values()
-            # {'GyZ': -235, 'GyY': 296, 'GyX': 16, 'Tmp': 26.64764, 'AcZ': -1552, 'AcY': -412, 'AcX': 16892}
-            change_x = abs(last_readings['GyX'] - accelerometer_values['GyX'])
-            change_y = abs(last_readings['GyY'] - accelerometer_values['GyY'])
-            change_z = abs(last_readings['GyZ'] - accelerometer_values['GyZ'])
-            last_readings = accelerometer_values
-            print("X:{}, Y:{}, Z:{}".format(change_x, change_y, change_z))
-            accelerometer_changes = (change_x, change_y, change_z)
-            if change_x + change_y + change_z > sensitivity:
+            # drained in chunks, carrying the largest change and last reading across reads, so long sample
+            # periods still get every sample
+            change[0] = change[1] = change[2] = 0
+            best = 0
+            got = 0
+            drained = False
+            left = sample_secs
+            while left > 0:
+                wait = min(left, DRAIN_SECS)
+                await sleep(wait)
+                left -= wait
+                if motion_seen:
+                    # something moved, check the samples to see whether it was enough to count
+                    motion_seen = False
+                    drained = True
+                    count = read()
+                    got += count
+                    best = max_change(buf, count, last, change)
+                else:
+                    # no motion interrupt, drop the samples without reading them
+                    reset_fifo()
+            if not is_active:
+                # switched off part way through the period, so it shouldn't be published or counted
+                continue
+            if drained:
+                if not got:
+                    # no samples (the FIFO was just reset), so there's nothing to publish or count as idle
+                    continue
+                if DEBUG:
+                    print("X:{}, Y:{}, Z:{}".format(change[0], change[1], change[2]))
+                n = itoa(mv, 0, change[0])
+                mv[n] = 0x2c  # ','
+                n = itoa(mv, n + 1, change[1])
+                mv[n] = 0x2c
+                n = itoa(mv, n + 1, change[2])
+                # safe to hand over the buffer itself, it isn't touched again until this publish completes
+                await publish(READINGS_TOPIC, mv[:n], retain=False, qos=0)
+            if best > sens_sq:
                 idle_counter = 0
             else:
                 idle_counter += 1
             if idle_counter >= max_idle_periods:
-                print("Done!")
-                command = 'off'
-                notification = "We're done!"
+                if DEBUG:
+                    print("Done!")
+                await set_active(b'off')
+                await publish(NOTIFY_TOPIC, b"We're done!", False, 0)
+        else:
+            motion_seen = False
+            await sleep(sample_secs)
 
-        time.sleep(sample_secs)
+
+async def set_active(command):
+    global is_active, idle_counter
+    is_active = command in (b'on', b'ON')
+    if is_active:
+        idle_counter = 0
+        # drop whatever piled up (or overflowed) in the FIFO while inactive
+        reset_fifo()
+    # publish the state as understood, not the raw command, so the two always agree; state changes are rare,
+    # so use qos 1 to make sure the retained state isn't silently lost
+    await client.publish(ACTIVE_TOPIC, b'on' if is_active else b'off', retain=True, qos=1)
+
+
+async def command_loop():
+    global command
+    while True:
+        await command_event.wait()
+        command_event.clear()
+        pending, command = command, None
+        await set_active(pending)
 
 
 def handle_incoming_message(topic, msg, retained):
-    msg_string = str(msg, 'UTF-8')
-    topic_string = str(topic, 'UTF-8')
-    print(f'{topic_string}: {msg_string}')
-    if topic_string == CONFIG_TOPIC:
+    global command, sample_secs, max_idle_periods, sensitivity, sens_sq, motion_threshold
+    if DEBUG:
+        print(f'{topic}: {msg}')
+    if topic == COMMAND_TOPIC:
+        command = msg
+        command_event.set()
+    elif topic == CONFIG_TOPIC:
         if not retained:
             print("WARNING: config should be published with retain true!")
-        global config_done, sample_secs, max_idle_periods, sensitivity
         try:
-            config = json.loads(msg_string)
-            sample_secs = config.get('sampleSecs', sample_secs)
+            config = json.loads(msg)
+            # a period shorter than one FIFO sample has nothing to read and would never wait
+            sample_secs = max(config.get('sampleSecs', sample_secs), SAMPLE_MS / 1000)
             max_idle_periods = config.get('maxIdlePeriods', max_idle_periods)
             sensitivity = config.get('sensitivity', sensitivity)
+            sens_sq = sensitivity * sensitivity
+            motion_threshold = config.get('motionThreshold', motion_threshold)
+            set_motion_threshold(motion_threshold)
             print(
-                f'Configured with sampleSecs: {sample_secs}, maxIdlePeriods: {max_idle_periods}, sensitivity: {sensitivity}')
-            config_done = True
+                f'Configured with sampleSecs: {sample_secs}, maxIdlePeriods: {max_idle_periods}, sensitivity: {sensitivity}, '
+                f'motionThreshold: {motion_threshold}')
+            config_event.set()
         except Exception as e:
             print(f'Problem with config: {e}')
             sys.print_exception(e)
-    else:
-        global command
-        command = msg_string
 
 
 async def wifi_han(state):
@@ -107,48 +350,31 @@ async def conn_han(client):
 
 
 async def online():
-    await client.publish(DEVICE_STATUS_TOPIC, 'online', retain=True, qos=0)
+    await client.publish(DEVICE_STATUS_TOPIC, b'online', retain=True, qos=0)
 
 
 async def main():
     await client.connect()
-    await asyncio.sleep(2)  # Give broker time
     await online()
-    global command, is_active, accelerometer_changes, idle_counter, notification
-    while True:
-        while not config_done:
-            print("Config not found, will check again in a few secs...")
-            await asyncio.sleep(5)
-
-        if command:
-            is_active = True if command.lower() == 'on' else False
-            if is_active:
-                idle_counter = 0
-                accelerometer_changes = None
-            await client.publish(ACTIVE_TOPIC, command, True, 0)
-            command = None
-        if accelerometer_changes:
-            await client.publish(READINGS_TOPIC, str(accelerometer_changes), True, 0)
-            accelerometer_changes = None
-        if notification:
-            await client.publish(NOTIFY_TOPIC, notification, False, 0)
-            notification = None
-        await asyncio.sleep(1)
+    if not config_event.is_set():
+        print("Config not found, waiting for it...")
+    await config_event.wait()
+    await command_loop()
 
 
 mqtt_local.config['subs_cb'] = handle_incoming_message
 mqtt_local.config['connect_coro'] = conn_han
 mqtt_local.config['wifi_coro'] = wifi_han
-mqtt_local.config['will'] = [DEVICE_STATUS_TOPIC, 'offline', True, 0]
+mqtt_local.config['will'] = [DEVICE_STATUS_TOPIC, b'offline', True, 0]
 
 MQTTClient.DEBUG = False
 client = MQTTClient(mqtt_local.config)
 
 try:
-    _thread.start_new_thread(update_readings_thread, ())
-
     loop = asyncio.get_event_loop()
     loop.create_task(main())
+    loop.create_task(sample_loop())
+    loop.create_task(motion_loop())
     loop.run_forever()
 finally:
     client.close()